@@ -0,0 +1,87 @@
+import re
+import time
+import logging
+from collections import Counter
+from difflib import SequenceMatcher
+from typing import Dict, Optional
+
+from pyrogram.enums import ChatType
+from pyrogram.types import Message
+
+logger = logging.getLogger('Admission')
+
+PUNCTUATION_PATTERN = re.compile(r'[^\w\s]')
+
+class AdmissionFilter:
+    """Дешевый отбор сообщений до постановки в очередь: только O(1)-проверки и предфильтр имени"""
+
+    def __init__(self, config: dict, counters: Optional[Counter] = None, ping_timeout: float = 10):
+        self.allowed_chats = set(config['allowed_chats'])
+        self.threshold = config['name_match_threshold']
+        self.ping_timeout = ping_timeout
+        self.last_ping_time: Dict[int, float] = {}
+        self.counters = counters if counters is not None else Counter()
+
+        self.name_matchers = []
+        lengths = []
+        for name in config['bot_names']:
+            # ratio() не больше 2 * min(len) / (len(a) + len(b)), поэтому слова вне этого окна длин заведомо не совпадут
+            min_len = int(self.threshold * len(name) / (2 - self.threshold)) + 1
+            max_len = int(len(name) * (2 - self.threshold) / self.threshold) if self.threshold else len(name) * 2
+            # ratio() зависит от порядка аргументов: имя остается первой последовательностью, как в исходной проверке
+            matcher = SequenceMatcher(None, name, '')
+            self.name_matchers.append((name, min_len, max_len, matcher))
+            lengths += [min_len, max_len]
+        self.word_pattern = (
+            re.compile(rf'(?<!\w)\w{{{min(lengths)},{max(lengths)}}}(?!\w)') if lengths else None
+        )
+
+    def is_mentioned(self, message: Message) -> bool:
+        if not self.word_pattern or not message.text:
+            return False
+        text = PUNCTUATION_PATTERN.sub('', message.text).lower()
+        for match in self.word_pattern.finditer(text):
+            word = match.group()
+            for name, min_len, max_len, matcher in self.name_matchers:
+                if not min_len <= len(word) <= max_len:
+                    continue
+                matcher.set_seq2(word)
+                if matcher.quick_ratio() <= self.threshold:
+                    continue
+                ratio = matcher.ratio()
+                if ratio > self.threshold:
+                    logger.debug("Bot name matched: %s ~ %s (%.2f%%) in chat %s",
+                                 word, name, ratio * 100, message.chat.title)
+                    return True
+        return False
+
+    def is_direct_interaction(self, message: Message) -> bool:
+        reply = message.reply_to_message
+        return bool(
+            (reply and reply.from_user and reply.from_user.is_self) or
+            message.chat.type == ChatType.PRIVATE or
+            self.is_mentioned(message)
+        )
+
+    def admit(self, message: Message, now: Optional[float] = None) -> bool:
+        """Решает, ставить ли сообщение в очередь, и продлевает окно пинга чата при прямом обращении"""
+        now = time.time() if now is None else now
+        chat = message.chat
+        if not (message.text or message.sticker or message.animation):
+            return self._drop(message, 'dropped_type')
+        if chat.type != ChatType.PRIVATE and self.allowed_chats and chat.id not in self.allowed_chats:
+            return self._drop(message, 'dropped_chat')
+
+        if self.is_direct_interaction(message):
+            self.last_ping_time[chat.id] = now
+            self.counters['admitted_direct'] += 1
+            return True
+        if now - self.last_ping_time.get(chat.id, float('-inf')) < self.ping_timeout:
+            self.counters['admitted_window'] += 1
+            return True
+        return self._drop(message, 'dropped_idle')
+
+    def _drop(self, message: Message, reason: str) -> bool:
+        self.counters[reason] += 1
+        logger.debug("Message dropped (%s) in chat %s", reason, message.chat.title, extra={'sample': 'ignored_message'})
+        return False
@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import zlib
+import logging
+from pathlib import Path
+from typing import Iterable, List, Optional
+from dataclasses import dataclass, asdict, field
+
+logger = logging.getLogger('DigestArchive')
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+INDEX_FILE = 'index.jsonl'
+CHUNK_SIZE = 64 * 1024
+
+@dataclass
+class ArchiveEntry:
+    id: int
+    segment: str
+    offset: int
+    length: int
+    codec: str
+    start: float
+    end: float
+    chat_titles: List[str] = field(default_factory=list)
+    channels: List[str] = field(default_factory=list)
+
+class DigestArchive:
+    """Сжатый архив сводок: каждая сводка — независимый кадр в сегменте, индекс хранит его смещение"""
+
+    def __init__(self, directory: str, config: dict):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.index_file = self.directory / INDEX_FILE
+        self.max_segment_bytes = config.get('digest_archive_segment_mb', 16) * 1024 * 1024
+        self.max_total_bytes = config.get('digest_archive_max_total_mb', 512) * 1024 * 1024
+        self.max_age = config.get('digest_archive_max_age_days', 180) * 24 * 3600
+        self.codec = config.get('digest_archive_compression', 'gzip')
+        if self.codec == 'zstd' and zstandard is None:
+            logger.warning("zstandard is not installed, falling back to gzip")
+            self.codec = 'gzip'
+        self.entries: List[ArchiveEntry] = self._load_index()
+
+    def _load_index(self) -> List[ArchiveEntry]:
+        entries = []
+        if self.index_file.exists():
+            with self.index_file.open('r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        try:
+                            entries.append(ArchiveEntry(**json.loads(line)))
+                        except (TypeError, ValueError) as e:
+                            logger.error(f"Skipping broken archive index line: {e}")
+        return entries
+
+    def _compressor(self):
+        if self.codec == 'zstd':
+            return zstandard.ZstdCompressor().compressobj()
+        return zlib.compressobj(wbits=31)
+
+    def _next_id(self) -> int:
+        return self.entries[-1].id + 1 if self.entries else 1
+
+    def _current_segment(self) -> Path:
+        if self.entries:
+            last = self.directory / self.entries[-1].segment
+            if last.exists() and last.stat().st_size < self.max_segment_bytes and last.suffix == self._suffix():
+                return last
+        # Номер первой сводки в имени делает сегменты уникальными и упорядоченными
+        return self.directory / f"segment_{self._next_id():06d}_{time.strftime('%Y%m%d')}{self._suffix()}"
+
+    def _suffix(self) -> str:
+        return '.zst' if self.codec == 'zstd' else '.gz'
+
+    def append(self, record: dict, start: float, end: float,
+               chat_titles: Iterable[str] = (), channels: Iterable[str] = ()) -> ArchiveEntry:
+        """Потоково сжимает запись в конец текущего сегмента и дописывает строку индекса"""
+        segment = self._current_segment()
+        compressor = self._compressor()
+        with segment.open('ab') as f:
+            offset = f.tell()
+            buffer = []
+            size = 0
+            for chunk in json.JSONEncoder(ensure_ascii=False).iterencode(record):
+                buffer.append(chunk)
+                size += len(chunk)
+                if size >= CHUNK_SIZE:
+                    f.write(compressor.compress(''.join(buffer).encode('utf-8')))
+                    buffer, size = [], 0
+            f.write(compressor.compress(''.join(buffer).encode('utf-8')))
+            f.write(compressor.flush())
+            length = f.tell() - offset
+
+        entry = ArchiveEntry(
+            id=self._next_id(),
+            segment=segment.name,
+            offset=offset,
+            length=length,
+            codec=self.codec,
+            start=start,
+            end=end,
+            chat_titles=sorted(set(chat_titles)),
+            channels=sorted(set(channels))
+        )
+        with self.index_file.open('a', encoding='utf-8') as f:
+            f.write(json.dumps(asdict(entry), ensure_ascii=False) + '\n')
+        self.entries.append(entry)
+        self.rotate()
+        return entry
+
+    def find(self, since: float = None, until: float = None, chat_title: str = None) -> List[ArchiveEntry]:
+        """Ищет сводки, чей период пересекается с [since, until] и которые затрагивают chat_title"""
+        return [
+            entry for entry in self.entries
+            if (since is None or entry.end >= since) and
+            (until is None or entry.start <= until) and
+            (chat_title is None or chat_title in entry.chat_titles or chat_title in entry.channels)
+        ]
+
+    def fetch(self, entry: ArchiveEntry) -> dict:
+        """Читает и распаковывает только кадр нужной сводки"""
+        with (self.directory / entry.segment).open('rb') as f:
+            f.seek(entry.offset)
+            frame = f.read(entry.length)
+        if entry.codec == 'zstd':
+            if zstandard is None:
+                raise RuntimeError("zstandard is required to read zstd archive frames")
+            data = zstandard.ZstdDecompressor().decompressobj().decompress(frame)
+        else:
+            data = zlib.decompress(frame, wbits=31)
+        return json.loads(data.decode('utf-8'))
+
+    def latest(self) -> Optional[dict]:
+        return self.fetch(self.entries[-1]) if self.entries else None
+
+    def rotate(self):
+        """Удаляет самые старые сегменты сверх лимита возраста или общего размера"""
+        segments = list(dict.fromkeys(entry.segment for entry in self.entries))
+        if len(segments) < 2:
+            return
+        sizes = {name: (self.directory / name).stat().st_size
+                 for name in segments if (self.directory / name).exists()}
+        total = sum(sizes.values())
+        newest_end = {}
+        for entry in self.entries:
+            newest_end[entry.segment] = max(newest_end.get(entry.segment, 0), entry.end)
+
+        dropped = set()
+        # Текущий (последний) сегмент никогда не удаляем
+        for name in segments[:-1]:
+            if total <= self.max_total_bytes and time.time() - newest_end[name] <= self.max_age:
+                break
+            dropped.add(name)
+            total -= sizes.get(name, 0)
+        if not dropped:
+            return
+
+        self.entries = [entry for entry in self.entries if entry.segment not in dropped]
+        tmp_file = self.index_file.with_name(INDEX_FILE + '.tmp')
+        with tmp_file.open('w', encoding='utf-8') as f:
+            for entry in self.entries:
+                f.write(json.dumps(asdict(entry), ensure_ascii=False) + '\n')
+        os.replace(tmp_file, self.index_file)
+        for name in dropped:
+            (self.directory / name).unlink(missing_ok=True)
+        logger.info(f"Rotated out {len(dropped)} digest archive segments")
@@ -9,13 +9,12 @@ from dataclasses import dataclass, asdict
 from mistralai import Mistral
 from pyrogram import Client
 from pyrogram.types import Message
+from logs import PAYLOAD_LOGGER
+from archive import DigestArchive
+from resilience import ResilientCompletions
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger('DigestBot')
+payload_logger = logging.getLogger(PAYLOAD_LOGGER)
 
 # Создаем директорию для сводок если её нет
 Path('digests').mkdir(exist_ok=True)
@@ -32,14 +31,18 @@ class ChannelPost:
     text: str
 
 class DigestManager:
-    def __init__(self, app: Client, mistral_client: Mistral, config: dict):
+    def __init__(self, app: Client, mistral_client: Mistral, config: dict, store=None, llm: ResilientCompletions = None):
         self.app = app
         self.mistral = mistral_client
+        self.llm = llm or ResilientCompletions(mistral_client, config)
         self.config = config
+        # В режиме супервизора буферы сводки живут в общем хранилище, а не в памяти процесса
+        self.store = store
         self.message_groups: List[MessageGroup] = []
         self.channel_posts: List[ChannelPost] = []
         self.last_digest_time = time.time()
         self.digest_lock = asyncio.Lock()
+        self.archive = DigestArchive(config.get('digest_archive_dir', 'digests/archive'), config)
         
         # Проверяем конфигурацию
         self._validate_config()
@@ -59,38 +62,42 @@ class DigestManager:
         if missing_fields:
             logger.warning(f"Missing config fields: {', '.join(missing_fields)}")
 
-    async def save_message_group(self, chat_id: int, chat_title: str, 
-                               messages: List[Message], responses: List[str]):
-        """Save a group of messages and their responses to the digest"""
+    @staticmethod
+    def message_group_payload(chat_title: str, messages: List[Message], responses: List[str]) -> dict:
+        """Serialize a message group so it can be saved later or in another process"""
+        message_dicts = [{
+            'user_name': f"{msg.from_user.first_name} {msg.from_user.last_name or ''}" if msg.from_user else "Unknown",
+            'text': msg.text if msg.text else msg.caption if msg.caption else str(msg.sticker.emoji if msg.sticker else "")
+        } for msg in messages]
+        
+        response_dicts = [{
+            'text': resp
+        } for resp in responses]
+        
+        return asdict(MessageGroup(
+            chat_title=chat_title,
+            messages=message_dicts,
+            responses=response_dicts
+        ))
+
+    async def add_message_group(self, group: dict):
+        """Add a serialized message group to the digest; errors propagate so the caller can retry"""
+        if self.store:
+            await asyncio.to_thread(self.store.push, 'digest_groups', group)
+            logger.info(f"Queued message group from chat: {group['chat_title']} to shared store")
+            return
+
         async with self.digest_lock:
-            try:
-                message_dicts = [{
-                    'user_name': f"{msg.from_user.first_name} {msg.from_user.last_name or ''}" if msg.from_user else "Unknown",
-                    'text': msg.text if msg.text else msg.caption if msg.caption else str(msg.sticker.emoji if msg.sticker else "")
-                } for msg in messages]
-                
-                response_dicts = [{
-                    'text': resp
-                } for resp in responses]
-                
-                group = MessageGroup(
-                    chat_title=chat_title,
-                    messages=message_dicts,
-                    responses=response_dicts
-                )
-                
-                self.message_groups.append(group)
-                logger.info(f"Saved message group from chat: {chat_title} (Total groups: {len(self.message_groups)})")
-                
-                # Сохраняем текущее состояние в файл
-                await self._save_current_state()
-            except Exception as e:
-                logger.error(f"Error saving message group: {e}")
+            self.message_groups.append(MessageGroup(**group))
+            logger.info(f"Saved message group from chat: {group['chat_title']} (Total groups: {len(self.message_groups)})")
+            
+            # Сохраняем текущее состояние в файл
+            await self._save_current_state()
 
     async def monitor_channel_post(self, message: Message):
         """Monitor and save channel posts"""
         try:
-            logger.info(f"Monitoring channel post from: {message.chat.title} {message.chat.username} {message.chat.id}")
+            logger.debug("Monitoring channel post from: %s %s %s", message.chat.title, message.chat.username, message.chat.id)
             if message.chat.username not in self.config['monitored_channels']:
                 return
                 
@@ -99,6 +106,11 @@ class DigestManager:
                     channel_title=message.chat.title,
                     text=message.text if message.text else str(message.sticker.emoji if message.sticker else "")
                 )
+
+                if self.store:
+                    await asyncio.to_thread(self.store.push, 'channel_posts', asdict(post))
+                    logger.info(f"Queued post from channel: {message.chat.title} to shared store")
+                    return
                 
                 self.channel_posts.append(post)
                 logger.info(f"Saved post from channel: {message.chat.title} (Total posts: {len(self.channel_posts)})")
@@ -123,7 +135,7 @@ class DigestManager:
                     'monitored_channels': len(self.config['monitored_channels'])
                 }
             }
-            logger.info(f"Prepared digest data: {json.dumps(data['stats'], indent=2)}")
+            logger.debug("Prepared digest data: %s", data['stats'])
             return data
         except Exception as e:
             logger.error(f"Error preparing digest data: {e}")
@@ -139,20 +151,37 @@ class DigestManager:
         except Exception as e:
             logger.error(f"Error saving current state: {e}")
 
-    async def _save_digest_to_file(self, digest_data: dict):
-        """Save digest data to a JSON file for backup"""
+    async def _save_digest_to_archive(self, digest_data: dict, digest_text: str):
+        """Append the digest and its source data to the compressed archive"""
         try:
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            filename = f'digests/digest_{timestamp}.json'
-            with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(digest_data, f, ensure_ascii=False, indent=2)
-            logger.info(f"Saved digest to file: {filename}")
-            
-            # Также сохраняем последнюю сводку отдельно
-            with open('digests/latest_digest.json', 'w', encoding='utf-8') as f:
-                json.dump(digest_data, f, ensure_ascii=False, indent=2)
+            entry = await asyncio.to_thread(
+                self.archive.append,
+                {'digest_text': digest_text, 'data': digest_data},
+                start=self.last_digest_time,
+                end=time.time(),
+                chat_titles=[group.chat_title for group in self.message_groups],
+                channels=[post.channel_title for post in self.channel_posts]
+            )
+            logger.info(f"Archived digest #{entry.id} to {entry.segment} ({entry.length} bytes)")
         except Exception as e:
-            logger.error(f"Failed to save digest to file: {e}")
+            logger.error(f"Failed to archive digest: {e}")
+
+    def get_past_digest(self, at: float = None, chat_title: str = None) -> Optional[dict]:
+        """Fetch the digest covering the given moment (or the latest one), optionally for a given chat"""
+        entries = self.archive.find(since=at, until=at, chat_title=chat_title)
+        return self.archive.fetch(entries[-1]) if entries else None
+
+    async def _load_shared(self) -> Dict[str, int]:
+        """Load the buffers accumulated by workers in the shared store without removing them"""
+        groups = await asyncio.to_thread(self.store.peek, 'digest_groups')
+        posts = await asyncio.to_thread(self.store.peek, 'channel_posts')
+        self.message_groups = [MessageGroup(**group) for _, group in groups]
+        self.channel_posts = [ChannelPost(**post) for _, post in posts]
+        logger.info(f"Loaded {len(groups)} message groups and {len(posts)} channel posts from shared store")
+        return {
+            'digest_groups': groups[-1][0] if groups else 0,
+            'channel_posts': posts[-1][0] if posts else 0
+        }
 
     async def create_and_post_digest(self):
         """Create and post digest to the channel"""
@@ -162,23 +191,26 @@ class DigestManager:
 
         async with self.digest_lock:
             try:
+                # Buffers stay in the shared store until the digest is posted, so a crash loses nothing
+                loaded_ids = await self._load_shared() if self.store else {}
                 digest_data = self._prepare_digest_data()
                 if not digest_data:
                     logger.warning("No digest data to process")
                     return
 
                 logger.info("Requesting digest from Mistral...")
-                chat_response = self.mistral.agents.complete(
+                chat_response = await self.llm.complete(
                     agent_id=self.config['digest_agent_id'],
                     messages=[{
                         "role": "user",
                         "content": f"Create a digest post based on this data: {json.dumps(digest_data, ensure_ascii=False)}"
-                    }]
+                    }],
+                    timeout=self.config.get('llm_digest_timeout')
                 )
                 
                 digest_text = chat_response.choices[0].message.content
                 logger.info("Received digest from Mistral")
-                logger.info(f"Digest preview: {digest_text[:200]}...")
+                payload_logger.debug("Digest text: %s", digest_text)
 
                 # Post to channel
                 message = await self.app.send_message(
@@ -187,10 +219,12 @@ class DigestManager:
                 )
                 logger.info(f"Posted digest to channel: {message.link}")
                 
-                # Save digest to file for backup
-                await self._save_digest_to_file(digest_data)
+                # Save digest to the archive for backup
+                await self._save_digest_to_archive(digest_data, digest_text)
                 
                 # Clear the digest data
+                for buffer, last_id in loaded_ids.items():
+                    await asyncio.to_thread(self.store.discard, buffer, last_id)
                 self.message_groups.clear()
                 self.channel_posts.clear()
                 self.last_digest_time = time.time()
@@ -217,9 +251,11 @@ class DigestManager:
                 logger.error(f"Error in digest loop: {e}", exc_info=True)
                 await asyncio.sleep(60)  # Wait before retrying
 
-def setup(app: Client, mistral_client: Mistral, config: dict) -> DigestManager:
-    """Setup the digest manager and start the digest loop"""
+def setup(app: Client, mistral_client: Mistral, config: dict, store=None, owner: bool = True,
+          llm: ResilientCompletions = None) -> DigestManager:
+    """Setup the digest manager and start the digest loop if this process owns the digest"""
     logger.info("Setting up DigestManager...")
-    digest_manager = DigestManager(app, mistral_client, config)
-    asyncio.create_task(digest_manager.start_digest_loop())
+    digest_manager = DigestManager(app, mistral_client, config, store=store, llm=llm)
+    if owner:
+        asyncio.create_task(digest_manager.start_digest_loop())
     return digest_manager
@@ -0,0 +1,79 @@
+import time
+import random
+import asyncio
+import logging
+from collections import Counter
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from store import SharedStore
+
+logger = logging.getLogger('JobQueue')
+
+class JobQueue:
+    """Долговечная очередь фоновых задач на SQLite с пулом обработчиков и повторами"""
+
+    def __init__(self, path: str, config: dict, counters: Optional[Counter] = None):
+        self.store = SharedStore(path)
+        self.worker_count = config.get('job_workers', 2)
+        self.max_attempts = config.get('job_max_attempts', 5)
+        self.backoff = config.get('job_retry_backoff', 5)
+        self.handlers: Dict[str, Callable[[dict], Awaitable]] = {}
+        self.counters = counters if counters is not None else Counter()
+        self.wakeup = asyncio.Event()
+        self.workers: List[asyncio.Task] = []
+
+    def register(self, kind: str, handler: Callable[[dict], Awaitable]):
+        """Регистрирует обработчик задач типа kind; ошибка обработчика ведет к повтору"""
+        self.handlers[kind] = handler
+
+    async def submit(self, kind: str, payload: dict):
+        await asyncio.to_thread(self.store.add_job, kind, payload)
+        self.counters['jobs_submitted'] += 1
+        self.wakeup.set()
+
+    async def start(self):
+        requeued = await asyncio.to_thread(self.store.requeue_running_jobs)
+        if requeued:
+            logger.info(f"Requeued {requeued} jobs interrupted by a previous shutdown")
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+        logger.info(f"Started {self.worker_count} job workers")
+
+    async def _wait_for_work(self):
+        self.wakeup.clear()
+        next_time = await asyncio.to_thread(self.store.next_job_time)
+        timeout = 5 if next_time is None else min(max(next_time - time.time(), 0.05), 5)
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _worker(self):
+        while True:
+            try:
+                job = await asyncio.to_thread(self.store.claim_job)
+                if job is None:
+                    await self._wait_for_work()
+                    continue
+                await self._run(*job)
+            except Exception as e:
+                logger.error(f"Error in job worker: {e}")
+                await asyncio.sleep(1)
+
+    async def _run(self, job_id: int, kind: str, payload: dict, attempts: int):
+        handler = self.handlers.get(kind)
+        try:
+            if handler is None:
+                raise LookupError(f"No handler registered for job kind '{kind}'")
+            await handler(payload)
+        except Exception as e:
+            give_up = attempts + 1 >= self.max_attempts
+            delay = random.uniform(0.5, 1.5) * self.backoff * 2 ** attempts
+            await asyncio.to_thread(self.store.retry_job, job_id, time.time() + delay, str(e), give_up)
+            self.counters['jobs_failed' if give_up else 'jobs_retried'] += 1
+            if give_up:
+                logger.error(f"Job {job_id} ({kind}) failed after {attempts + 1} attempts: {e}")
+            else:
+                logger.warning(f"Job {job_id} ({kind}) failed, retrying in {delay:.1f}s: {e}")
+            return
+        await asyncio.to_thread(self.store.complete_job, job_id)
+        self.counters['jobs_completed'] += 1
@@ -2,6 +2,7 @@ import asyncio, re
 from pyrogram import Client, filters
 from pyrogram.types import Message
 from mistralai import Mistral
+from resilience import ResilientCompletions
 
 LEO_BOT_USERNAME = "leomatchbot"
 
@@ -11,9 +12,10 @@ def clean_response(response):
     return response.strip()
 
 class LeoBot:
-    def __init__(self, app: Client, mistral_client: Mistral, config: dict):
+    def __init__(self, app: Client, mistral_client: Mistral, config: dict, llm: ResilientCompletions = None):
         self.app = app
         self.mistral_client = mistral_client
+        self.llm = llm or ResilientCompletions(mistral_client, config)
         self.config = config
         self.is_running = False
         self.leo_chat_id = None
@@ -44,7 +46,7 @@ class LeoBot:
         await self.send_message("1")
 
     async def rate_profile(self, profile_text: str) -> int:
-        response = self.mistral_client.agents.complete(
+        response = await self.llm.complete(
             agent_id="ag:93cb32c3:20240907:leo:ae61fce4",
             messages=[
                 {"role": "user", "content": f"{profile_text}"}
@@ -70,15 +72,15 @@ class LeoBot:
                 reaction = await self.get_reaction(rating)
                 await self.send_message(reaction)
                 if reaction == "💌 / 📹":
-                    response = self.mistral_client.agents.complete(agent_id=self.config['mistral_agent_id'], messages=[{"role": "user", "content": f"Ты листал бота для поиска знакомств и тебе очень понравилась эта анкета: {profile_message.text}, придумай что написать ей, пиши влюбчиво и очень возбуждённо, но веди себя максимально серьёзно и умно! Максимум 300 символов в ответе."}])
+                    response = await self.llm.complete(agent_id=self.config['mistral_agent_id'], messages=[{"role": "user", "content": f"Ты листал бота для поиска знакомств и тебе очень понравилась эта анкета: {profile_message.text}, придумай что написать ей, пиши влюбчиво и очень возбуждённо, но веди себя максимально серьёзно и умно! Максимум 300 символов в ответе."}])
                     await self.send_message(clean_response(response.choices[0].message.content.strip()))
 
             except Exception as e:
                 print(f"An error occurred: {e}")
             await asyncio.sleep(5)
 
-def setup(app: Client, mistral_client: Mistral, config: dict):
-    leo_bot = LeoBot(app, mistral_client, config)
+def setup(app: Client, mistral_client: Mistral, config: dict, llm: ResilientCompletions = None):
+    leo_bot = LeoBot(app, mistral_client, config, llm=llm)
 
     @app.on_message(filters.command("leo_start") & filters.private)
     async def start_leo_bot(client, message):
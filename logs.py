@@ -0,0 +1,78 @@
+import queue
+import atexit
+import logging
+import logging.handlers
+from collections import Counter
+from pathlib import Path
+
+PAYLOAD_LOGGER = 'payloads'
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Кладет запись в очередь как есть: сообщение форматируется уже в фоновом потоке"""
+
+    def prepare(self, record):
+        return record
+
+class SamplingFilter(logging.Filter):
+    """Пропускает каждую N-ю запись, помеченную через extra={'sample': key}"""
+
+    def __init__(self, sample_every: dict):
+        super().__init__()
+        self.sample_every = sample_every
+        self.seen = Counter()
+
+    def filter(self, record):
+        key = getattr(record, 'sample', None)
+        every = self.sample_every.get(key, 1) if key else 1
+        if every <= 1:
+            return True
+        self.seen[key] += 1
+        if (self.seen[key] - 1) % every:
+            return False
+        record.msg = f"{record.msg} [sampled 1/{every}, seen {self.seen[key]}]"
+        return True
+
+def setup_logging(config: dict, worker_name: str = None) -> logging.handlers.QueueListener:
+    """Настраивает неблокирующее логирование: запись в stderr и файл payload-ов идет из фонового потока"""
+    formatter = logging.Formatter(LOG_FORMAT)
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(config.get('log_sample_every', {})))
+
+    root = logging.getLogger()
+    root.handlers.clear()
+    root.setLevel(config.get('log_level', 'INFO'))
+    root.addHandler(queue_handler)
+    for name, level in config.get('log_levels', {}).items():
+        logging.getLogger(name).setLevel(level)
+
+    console = logging.StreamHandler()
+    console.setFormatter(formatter)
+    handlers = [console]
+
+    payload_file = config.get('payload_log_file')
+    if payload_file and worker_name:
+        # RotatingFileHandler не умеет делить файл между процессами, поэтому у каждого воркера свой
+        path = Path(payload_file)
+        payload_file = str(path.with_name(f"{path.stem}.{worker_name}{path.suffix}"))
+    if payload_file:
+        # Промпты и ответы модели уходят только в отдельный ротируемый файл, не засоряя основной лог
+        Path(payload_file).parent.mkdir(parents=True, exist_ok=True)
+        file_handler = logging.handlers.RotatingFileHandler(
+            payload_file, maxBytes=10 * 1024 * 1024, backupCount=5, encoding='utf-8'
+        )
+        file_handler.setFormatter(formatter)
+        file_handler.addFilter(lambda record: record.name == PAYLOAD_LOGGER)
+        console.addFilter(lambda record: record.name != PAYLOAD_LOGGER)
+        handlers.append(file_handler)
+
+        payload_logger = logging.getLogger(PAYLOAD_LOGGER)
+        payload_logger.setLevel(logging.DEBUG)
+        payload_logger.propagate = False
+        payload_logger.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
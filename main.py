@@ -3,26 +3,32 @@ import time
 import random
 import asyncio
 import logging
+import os
 import re
 
-import leo
-import channel
-import memory
+import logs
+import startup
+import admission
+import jobs
+import sharding
 
-from difflib import SequenceMatcher
-from mistralai import Mistral
+from collections import Counter
 from pyrogram import Client, filters
 from pyrogram.enums import ChatType, ChatAction
 from pyrogram.raw import functions, types
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-logger = logging.getLogger(__name__)
-
 with open('config.json', 'r', encoding='utf-8') as f:
     config = json.load(f)
 
-client = Mistral(api_key=config['mistral_api_key'])
-app = Client("my_account", api_id=config['tg_api_id'], api_hash=config['tg_api_hash'])
+worker = sharding.load_worker_spec()
+logs.setup_logging(config, worker_name=worker.name if worker.store_path else None)
+logger = logging.getLogger(__name__)
+payload_logger = logging.getLogger(logs.PAYLOAD_LOGGER)
+
+store = None
+client = None
+llm = None
+app = Client(worker.session, api_id=config['tg_api_id'], api_hash=config['tg_api_hash'])
 
 last_activity_time = 0
 is_online = False
@@ -30,6 +36,11 @@ message_queue = asyncio.Queue()
 me = None
 digest_manager = None
 memory_manager = None
+summary_manager = None
+background_jobs = None
+shared_jobs = None
+stats = Counter()
+admission_filter = admission.AdmissionFilter(config, counters=stats)
 
 def contains_emoji(text):
     emoji_pattern = re.compile("["
@@ -47,14 +58,38 @@ def chat_filter_func(_, __, message):
         return False
     if message.text and message.text.strip().lower() in ['/leo_start', '/leo_stop']:
         return False
-    if config['allowed_chats'] and message.chat.id in config['allowed_chats']:
-        return True
-    return filters.private and (filters.text | filters.sticker | filters.animation)
+    return True
+
+def get_chat_title(chat):
+    if chat.title:
+        return chat.title
+    if chat.type == ChatType.PRIVATE and chat.first_name:
+        return f"{chat.first_name} {chat.last_name or ''}".strip()
+    return "Unknown Chat"
+
+def format_history_message(message):
+    if not (message.text or message.sticker or message.animation):
+        return None
+    if message.from_user: name = f"{message.from_user.first_name} {message.from_user.last_name or ''}"
+    elif message.sender_chat: name = message.sender_chat.title
+    else: name = "Unknown"
+    role = "assistant" if message.from_user and message.from_user.is_self else "user"
+    mentioned = is_mentioned(message)
+
+    message_text = f"[{name.strip()}]: {'[Mentioned] ' if mentioned else ''}"
+    if message.text:
+        message_text += str(message.text)
+    elif message.sticker:
+        message_text += '{'+str(message.sticker.emoji)+' sticker}'
+    elif message.animation:
+        gif_info = extract_gif_info(message.animation)
+        message_text += '{'+str(gif_info)+' gif}'
+    return role, message_text
 
-async def get_chat_history(chat_id, limit, current_message_id):
+async def get_chat_history(chat_id, limit, current_message_id, chat_title=None):
     messages = []
 
-    relevant_memory = memory_manager.get_relevant_memory()
+    relevant_memory = memory_manager.get_relevant_memory(chat_title=chat_title)
     messages.insert(0, {
         "role": "assistant",
         "content": f"Моя память:\n{relevant_memory}"
@@ -62,14 +97,13 @@ async def get_chat_history(chat_id, limit, current_message_id):
 
     current_role = None
     current_content = []
+    oldest_id = None
     
     async for message in app.get_chat_history(chat_id, limit=limit, offset_id=current_message_id):
-        if message.text or message.sticker or message.animation:
-            if message.from_user: name = f"{message.from_user.first_name} {message.from_user.last_name or ''}"
-            elif message.sender_chat: name = message.sender_chat.title
-            else: name = "Unknown"
-            role = "assistant" if message.from_user and message.from_user.is_self else "user"
-            mentioned = is_mentioned(message)
+        oldest_id = message.id
+        formatted = format_history_message(message)
+        if formatted:
+            role, message_text = formatted
             
             if role != current_role:
                 if current_role:
@@ -77,20 +111,20 @@ async def get_chat_history(chat_id, limit, current_message_id):
                 current_role = role
                 current_content = []
             
-            message_text = f"[{name.strip()}]: {'[Mentioned] ' if mentioned else ''}"
-            if message.text:
-                message_text += str(message.text)
-            elif message.sticker:
-                message_text += '{'+str(message.sticker.emoji)+' sticker}'
-            elif message.animation:
-                gif_info = extract_gif_info(message.animation)
-                message_text += '{'+str(gif_info)+' gif}'
-            
             current_content.append(message_text)
     if current_role:
         messages.append({"role": current_role, "content": "\n".join(current_content[::-1])})
     messages[1:] = messages[1:][::-1]
-    logger.info(messages)
+
+    if summary_manager and oldest_id is not None:
+        # Всё, что старше окна истории, попадает в промпт только в виде свернутой сводки
+        summary = summary_manager.get_summary(chat_id)
+        if summary:
+            messages.insert(1, {
+                "role": "assistant",
+                "content": f"Краткое содержание более ранней беседы:\n{summary}"
+            })
+        summary_manager.schedule_refresh(chat_id, oldest_id)
     return messages
 
 def extract_gif_info(animation):
@@ -101,9 +135,9 @@ def extract_gif_info(animation):
     else:
         return "Unknown GIF"
 
-async def get_response(message, chat_id, message_id, name="unknown"):
+async def get_response(message, chat_id, message_id, name="unknown", chat_title=None):
     await asyncio.sleep(0.5)
-    chat_history = await get_chat_history(chat_id, config['message_memory'], message_id)
+    chat_history = await get_chat_history(chat_id, config['message_memory'], message_id, chat_title)
     
     if isinstance(message, str):
         content = message
@@ -118,8 +152,17 @@ async def get_response(message, chat_id, message_id, name="unknown"):
         content = "Unsupported message type"
     
     chat_history.append({"role": "user", "content": f"[{name}]: {content}"})
+    if payload_logger.isEnabledFor(logging.DEBUG):
+        # Запись форматируется позже в потоке логов, поэтому передаем готовую строку, а не изменяемый список
+        payload_logger.debug("Prompt for chat %s: %s", chat_id, json.dumps(chat_history, ensure_ascii=False))
     
-    chat_response = client.agents.complete(agent_id=config['mistral_agent_id'], messages=chat_history)
+    try:
+        chat_response = await llm.complete(agent_id=config['mistral_agent_id'], messages=chat_history, hedge=True)
+    except Exception as e:
+        # Провайдер недоступен или не уложился в дедлайн: отвечаем дешевой заглушкой вместо тишины
+        stats['llm_fallbacks'] += 1
+        logger.warning("Mistral недоступен, отвечаем заглушкой: %s", e)
+        return config.get('llm_fallback_reply', '{🙂 sticker}')
     assistant_response = chat_response.choices[0].message.content
     return assistant_response
 
@@ -143,15 +186,7 @@ async def simulate_online_status():
         await asyncio.sleep(10)
 
 def is_mentioned(message):
-    bot_names = config['bot_names']
-    name_match_threshold = config['name_match_threshold']
-    text = re.sub(r'[^\w\s]', '', message.text or '').lower().split()
-    for word in text:
-        for name in bot_names:
-            if SequenceMatcher(None, name, word).ratio() > name_match_threshold:
-                logger.info(f"Имя бота найдено по проценту сходства: {name} | Процент сходства: {SequenceMatcher(None, name, word).ratio() * 100:.2f}% | Чат: {message.chat.title} | Пользователь: {message.from_user.first_name}")
-                return True
-    return False
+    return admission_filter.is_mentioned(message)
 
 async def get_all_stickers(client):
     try:
@@ -220,146 +255,237 @@ async def send_random_sticker(client, chat_id, emoji):
 
 @app.on_message(filters.channel)
 async def monitor_channels(client, message):
-    logger.info(f"Получено сообщение в канале: {message.text}")
+    if not worker.runs('digest'):
+        return
+    logger.info("Получено сообщение в канале: %s", message.text, extra={'sample': 'channel_post'})
     if digest_manager:
         await digest_manager.monitor_channel_post(message)
 
 @app.on_message(filters.create(chat_filter_func) & ~(filters.channel))
 async def auto_reply(client, message):
+    if not worker.runs('replies') or not worker.owns_chat(message.chat.id):
+        return
+    if not admission_filter.admit(message):
+        return
+    stats['enqueued'] += 1
     await message_queue.put([client, message])
 
 async def process_queue():
     global is_online, last_activity_time
     message_groups = {}
-    last_ping_time = {}
-    ping_timeout = 10
     
     while True:
         try:
             client, message = await message_queue.get()
             chat_id = message.chat.id
             current_time = time.time()
+
+            if not is_online:
+                await asyncio.sleep(random.uniform(config['delay_before_online'][0], config['delay_before_online'][1]))
+                await app.invoke(functions.account.UpdateStatus(offline=False))
+                is_online = True
+                logger.info("Статус: онлайн")
+            last_activity_time = current_time
             
-            is_direct_interaction = (
-                (message.reply_to_message and message.reply_to_message.from_user and message.reply_to_message.from_user.is_self) or 
-                message.chat.type == ChatType.PRIVATE or 
-                is_mentioned(message)
-            )
-            
-            if is_direct_interaction or (
-                chat_id in last_ping_time and 
-                current_time - last_ping_time[chat_id] < ping_timeout
-            ):
-                if is_direct_interaction:
-                    last_ping_time[chat_id] = current_time
-
-                if not is_online:
-                    await asyncio.sleep(random.uniform(config['delay_before_online'][0], config['delay_before_online'][1]))
-                    await app.invoke(functions.account.UpdateStatus(offline=False))
-                    is_online = True
-                    logger.info("Статус: онлайн")
-                last_activity_time = current_time
-                
-                await client.read_chat_history(chat_id)                
+            await client.read_chat_history(chat_id)                
 
-                if chat_id not in message_groups:
-                    message_groups[chat_id] = {
-                        'messages': [],
-                        'timer': None
-                    }
-                
-                message_groups[chat_id]['messages'].append((client, message))
-                
-                if message_groups[chat_id]['timer'] is not None:
-                    message_groups[chat_id]['timer'].cancel()
+            if chat_id not in message_groups:
+                message_groups[chat_id] = {
+                    'messages': [],
+                    'timer': None
+                }
+            
+            message_groups[chat_id]['messages'].append((client, message))
+            
+            if message_groups[chat_id]['timer'] is not None:
+                message_groups[chat_id]['timer'].cancel()
+            
+            async def process_message_group(chat_id):
+                await asyncio.sleep(10)  # Ждём 10 секунд для группировки
                 
-                async def process_message_group(chat_id):
-                    await asyncio.sleep(10)  # Ждём 10 секунд для группировки
+                if chat_id in message_groups:
+                    # Забираем группу сразу: сообщения, пришедшие во время ответа, соберутся в новую группу
+                    group = message_groups.pop(chat_id)
+                    last_client, last_message = group['messages'][-1]
                     
-                    if chat_id in message_groups:
-                        last_client, last_message = message_groups[chat_id]['messages'][-1]
-                        
-                        content_type = "text" if last_message.text else "sticker" if last_message.sticker else "GIF" if last_message.animation else "unknown"
-                        content = last_message.text or last_message.caption or (last_message.sticker.emoji if last_message.sticker else (extract_gif_info(last_message.animation) if last_message.animation else "unknown"))
-                        chat_title = last_message.chat.title or "Unknown Chat"
-                        user_first_name = last_message.from_user.first_name if last_message.from_user and last_message.from_user.first_name else "Unknown"
-                        user_last_name = last_message.from_user.last_name if last_message.from_user and last_message.from_user.last_name else ""
-                        user_username = message.from_user.username if message.from_user and message.from_user.username else "Unknown"
-                        
-                        logger.info(f"Обработка группы сообщений. Последнее сообщение: {content_type}: {content} | Чат: {chat_title} | Пользователь: {user_username}")
+                    content_type = "text" if last_message.text else "sticker" if last_message.sticker else "GIF" if last_message.animation else "unknown"
+                    content = last_message.text or last_message.caption or (last_message.sticker.emoji if last_message.sticker else (extract_gif_info(last_message.animation) if last_message.animation else "unknown"))
+                    chat_title = get_chat_title(last_message.chat)
+                    user_first_name = last_message.from_user.first_name if last_message.from_user and last_message.from_user.first_name else "Unknown"
+                    user_last_name = last_message.from_user.last_name if last_message.from_user and last_message.from_user.last_name else ""
+                    user_username = message.from_user.username if message.from_user and message.from_user.username else "Unknown"
+                    
+                    logger.info("Обработка группы сообщений. Последнее сообщение: %s: %s | Чат: %s | Пользователь: %s",
+                                content_type, content, chat_title, user_username)
+                    
+                    response = await get_response(
+                        message=last_message,
+                        chat_id=chat_id,
+                        message_id=last_message.id,
+                        name=f"{user_first_name} {user_last_name}".strip(),
+                        chat_title=chat_title
+                    )
+                    
+                    messages_sent = []
+                    for part in filter(None, response.split(f"[{me.first_name} {me.last_name}]: ")):
+                        logger.info("Ответ отправлен | Чат: %s | Пользователь: %s", chat_title, user_username)
+                        payload_logger.debug("Reply part for chat %s: %s", chat_id, part)
+                        await simulate_typing(last_client, chat_id, part)
                         
-                        response = await get_response(
-                            message=last_message,
-                            chat_id=chat_id,
-                            message_id=last_message.id,
-                            name=f"{user_first_name} {user_last_name}".strip()
-                        )
+                        gif_match = re.search(r'\{(.*?)[\s_]?gif\}', part, re.IGNORECASE)
+                        sticker_match = re.search(r'\{(.*?)[\s_]?sticker\}', part, re.IGNORECASE)
+
+                        if gif_match:
+                            query = gif_match.group(1).strip()
+                            if contains_emoji(query):
+                                await send_random_sticker(last_client, chat_id, query)
+                            else:
+                                await send_gif(last_client, chat_id, query)
+                            part = re.sub(r'\{.*?gif\}', '', part, flags=re.IGNORECASE).strip()
+                        elif sticker_match:
+                            query = sticker_match.group(1).strip()
+                            if contains_emoji(query):
+                                await send_random_sticker(last_client, chat_id, query)
+                            else:
+                                await send_gif(last_client, chat_id, query)
+                            part = re.sub(r'\{.*?sticker\}', '', part, flags=re.IGNORECASE).strip()
                         
-                        messages_sent = []
-                        for part in filter(None, response.split(f"[{me.first_name} {me.last_name}]: ")):
-                            logger.info(f"Ответ отправлен: {part} | Чат: {chat_title} | Пользователь: {user_username}")
-                            await simulate_typing(last_client, chat_id, part)
-                            
-                            gif_match = re.search(r'\{(.*?)[\s_]?gif\}', part, re.IGNORECASE)
-                            sticker_match = re.search(r'\{(.*?)[\s_]?sticker\}', part, re.IGNORECASE)
-
-                            if gif_match:
-                                query = gif_match.group(1).strip()
-                                if contains_emoji(query):
-                                    await send_random_sticker(last_client, chat_id, query)
-                                else:
-                                    await send_gif(last_client, chat_id, query)
-                                part = re.sub(r'\{.*?gif\}', '', part, flags=re.IGNORECASE).strip()
-                            elif sticker_match:
-                                query = sticker_match.group(1).strip()
-                                if contains_emoji(query):
-                                    await send_random_sticker(last_client, chat_id, query)
-                                else:
-                                    await send_gif(last_client, chat_id, query)
-                                part = re.sub(r'\{.*?sticker\}', '', part, flags=re.IGNORECASE).strip()
-                            
-                            if part:
-                                sent_msg = await last_message.reply(part)
-                                messages_sent.append(sent_msg)
-
-                        await asyncio.sleep(0.5)
+                        if part:
+                            sent_msg = await last_message.reply(part)
+                            messages_sent.append(sent_msg)
+
+                    stats['groups_processed'] += 1
+
+                    # Память и сводка обрабатываются фоновыми задачами, ответ на этом завершен
+                    group_messages = [msg[1] for msg in group['messages']]
+                    bot_responses = [msg.text for msg in messages_sent if msg.text]
+                    try:
                         if memory_manager:
-                            await memory_manager.process_conversation(
-                                messages=[msg[1] for msg in message_groups[chat_id]['messages']],
-                                bot_responses=[msg.text for msg in messages_sent if msg.text],
-                                chat_title=chat_title
-                            )
-                        
+                            await background_jobs.submit('memory', memory_manager.conversation_payload(
+                                group_messages, bot_responses, chat_title
+                            ))
                         if digest_manager:
-                            await digest_manager.save_message_group(
-                                chat_id=chat_id,
-                                chat_title=last_message.chat.title or "Unknown Chat",
-                                messages=[msg[1] for msg in message_groups[chat_id]['messages']],
-                                responses=[msg.text for msg in messages_sent if msg.text]
-                            )
-                        del message_groups[chat_id]
-                timer = asyncio.create_task(process_message_group(chat_id))
-                message_groups[chat_id]['timer'] = timer
-            else: logger.info(f"Сообщение проигнорировано: {message.text or 'Не текстовое сообщение'} | Чат: {(message.chat.title if message.chat else 'Unknown Chat')} | Пользователь: {(message.from_user.username if message.from_user else 'Unknown')}")
+                            await background_jobs.submit('digest', digest_manager.message_group_payload(
+                                last_message.chat.title or "Unknown Chat", group_messages, bot_responses
+                            ))
+                    except Exception as e:
+                        logger.error(f"Ошибка при постановке фоновых задач: {e}")
+            timer = asyncio.create_task(process_message_group(chat_id))
+            message_groups[chat_id]['timer'] = timer
         except Exception as e:
+            stats['errors'] += 1
             logger.error(f"Ошибка при обработке сообщения: {e}")
         finally:
             message_queue.task_done()
 
+def create_mistral_client():
+    from mistralai import Mistral
+    return Mistral(api_key=config['mistral_api_key'])
+
+def import_subsystems():
+    import channel, memory, leo, summary, resilience
+    return channel, memory, leo, summary, resilience
+
+async def warm_stickers():
+    if not hasattr(app, 'all_sticker_sets'):
+        app.all_sticker_sets = await get_all_stickers(app)
+    logger.info(f"Sticker cache warmed: {len(app.all_sticker_sets)} sets")
+
+async def warm_chat_history():
+    for chat_id in filter(worker.owns_chat, config['allowed_chats']):
+        try:
+            async for _ in app.get_chat_history(chat_id, limit=config['message_memory']):
+                pass
+        except Exception as e:
+            logger.warning(f"Не удалось прогреть историю чата {chat_id}: {e}")
+
+async def report_worker_health():
+    while True:
+        try:
+            await asyncio.to_thread(store.report_metrics, worker.name, {
+                'pid': os.getpid(),
+                'session': worker.session,
+                'subsystems': worker.subsystems,
+                'shard': f"{worker.shard_index}/{worker.shard_count}",
+                'queue_size': message_queue.qsize(),
+                'counters': dict(stats)
+            })
+        except Exception as e:
+            logger.error(f"Ошибка при отправке метрик воркера: {e}")
+        await asyncio.sleep(15)
+
+async def log_stats():
+    # Счетчики отбора, LLM и фоновых задач видны в логе в любом режиме, а не только в метриках супервизора
+    last_snapshot = None
+    while True:
+        await asyncio.sleep(config.get('stats_log_interval', 60))
+        snapshot = dict(stats)
+        if snapshot != last_snapshot:
+            logger.info("Счетчики: %s", ", ".join(f"{key}={value}" for key, value in sorted(snapshot.items())))
+            last_snapshot = snapshot
+
 async def main():
-    global me, digest_manager, memory_manager
-    logger.info("Starting bot...")
-    await app.start()
-    me = await app.get_me()
+    global me, client, llm, store, digest_manager, memory_manager, summary_manager, background_jobs, shared_jobs
+    logger.info(f"Starting bot (worker {worker.name}, subsystems: {', '.join(worker.subsystems)})...")
+    if worker.store_path:
+        from store import SharedStore
+        store = SharedStore(worker.store_path)
+        asyncio.create_task(report_worker_health())
+    asyncio.create_task(log_stats())
+    boot = startup.StartupOrchestrator()
+    stages = await boot.gather(
+        app_start=app.start(),
+        mistral_client=asyncio.to_thread(create_mistral_client),
+        subsystems=asyncio.to_thread(import_subsystems)
+    )
+    client = stages['mistral_client']
+    channel, memory, leo, summary, resilience = stages['subsystems']
+    llm = resilience.ResilientCompletions(client, config, counters=stats)
+
+    stages = await boot.gather(
+        get_me=app.get_me(),
+        update_status=app.invoke(functions.account.UpdateStatus(offline=True))
+    )
+    me = stages['get_me']
     logger.info(f"Bot started as {me.first_name} {me.last_name} (@{me.username})")
-    await app.invoke(functions.account.UpdateStatus(offline=True))
-    digest_manager = channel.setup(app, client, config)
-    memory_manager = memory.setup(app, client, config)
-    logger.info("Digest manager initialized")
-    asyncio.create_task(process_queue())
-    leo.setup(app, client, config)
+
+    if worker.runs('digest') or worker.runs('replies'):
+        digest_manager = channel.setup(app, client, config, store=store, owner=worker.runs('digest'), llm=llm)
+        logger.info("Digest manager initialized")
+    if worker.runs('memory') or worker.runs('replies'):
+        memory_manager = memory.setup(app, client, config, store=store, owner=worker.runs('memory'), llm=llm)
+    if store and worker.runs('memory'):
+        # Беседы от остальных воркеров лежат задачами в общем хранилище и удаляются только после обработки
+        shared_jobs = jobs.JobQueue(worker.store_path, config, counters=stats)
+        shared_jobs.register('memory', memory_manager.process_conversation_data)
+        await shared_jobs.start()
+    if worker.runs('leo'):
+        leo.setup(app, client, config, llm=llm)
+    if worker.runs('replies'):
+        summary_manager = summary.setup(
+            app, client, config, format_history_message,
+            summary_file=f"summaries.{worker.name}.json" if worker.store_path else 'summaries.json',
+            llm=llm
+        )
+        background_jobs = jobs.JobQueue(
+            f"jobs.{worker.name}.db" if worker.store_path else config.get('jobs_path', 'jobs.db'),
+            config, counters=stats
+        )
+        if memory_manager:
+            background_jobs.register('memory', memory_manager.handle_conversation)
+        if digest_manager:
+            background_jobs.register('digest', digest_manager.add_message_group)
+        await background_jobs.start()
+        asyncio.create_task(process_queue())
+    boot.mark_ready()
+
+    if memory_manager:
+        boot.warm("memory_index", memory_manager.ensure_loaded())
+    if worker.runs('replies'):
+        boot.warm("stickers", warm_stickers())
+        boot.warm("chat_history", warm_chat_history())
+    asyncio.create_task(boot.finish())
     await simulate_online_status()
 
 if __name__ == "__main__":
     app.run(main())
-    digest_manager = channel.setup(app, client, config)
@@ -1,19 +1,29 @@
 import asyncio
+import heapq
+import itertools
 import logging
+import math
+import os
+import re
 import time
+import zlib
 from datetime import datetime
 from pathlib import Path
-from typing import List, Dict
-from dataclasses import dataclass
+from typing import Iterable, List, Dict, Optional, Tuple
+from dataclasses import dataclass, field
+import numpy as np
 from pyrogram import Client
 from pyrogram.types import Message
 from mistralai import Mistral
+from logs import PAYLOAD_LOGGER
+from resilience import ResilientCompletions
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger('MemoryManager')
+payload_logger = logging.getLogger(PAYLOAD_LOGGER)
+
+NGRAM_SIZE = 3
+VECTOR_DIM = 512
+NON_WORD_PATTERN = re.compile(r'[^\w\s]')
 
 @dataclass
 class MemoryEntry:
@@ -22,91 +32,202 @@ class MemoryEntry:
     importance: int
     context: str
     chat_title: str
+    vector: Optional[np.ndarray] = field(default=None, repr=False, compare=False)
+
+def vectorize(texts: List[str]) -> np.ndarray:
+    """Строит нормированные векторы хешированных символьных n-грамм для списка текстов"""
+    rows, cols = [], []
+    for row, text in enumerate(texts):
+        normalized = ' ' + ' '.join(NON_WORD_PATTERN.sub(' ', text.lower()).split()) + ' '
+        for i in range(max(len(normalized) - NGRAM_SIZE + 1, 1)):
+            rows.append(row)
+            cols.append(zlib.crc32(normalized[i:i + NGRAM_SIZE].encode('utf-8')) % VECTOR_DIM)
+
+    vectors = np.zeros((len(texts), VECTOR_DIM), dtype=np.float32)
+    np.add.at(vectors, (np.array(rows, dtype=np.intp), np.array(cols, dtype=np.intp)), 1.0)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-9)
+
+def eviction_key(entry: MemoryEntry, half_life: float) -> float:
+    """Ключ вытеснения: log2 от importance * 2^(-age / half_life) без общего для всех слагаемого -now / half_life"""
+    # Поскольку сдвиг на текущее время одинаков для всех записей, порядок ключей не меняется со временем
+    return math.log2(max(entry.importance, 0.5)) + entry.timestamp / half_life
+
+class MemoryPartition:
+    """Записи памяти одного чата с собственной кучей вытеснения и векторным индексом"""
+
+    def __init__(self, chat_title: str):
+        self.chat_title = chat_title
+        self.entries: Dict[int, MemoryEntry] = {}
+        self.heap: List[tuple] = []
+        self._index: Optional[np.ndarray] = None
+        self._index_entries: List[MemoryEntry] = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, entry: MemoryEntry):
+        return self.entries.get(id(entry)) is entry
+
+    def add(self, entry: MemoryEntry):
+        self.entries[id(entry)] = entry
+        self._index = None
+
+    def remove(self, entry: MemoryEntry):
+        del self.entries[id(entry)]
+        self._index = None
+
+    def invalidate_index(self):
+        self._index = None
+
+    def get_index(self):
+        """Возвращает матрицу векторов записей чата и список записей в том же порядке"""
+        if self._index is None:
+            self._index_entries = list(self.entries.values())
+            missing = [entry for entry in self._index_entries if entry.vector is None]
+            for entry, vector in zip(missing, vectorize([entry.content for entry in missing])):
+                entry.vector = vector
+            if self._index_entries:
+                self._index = np.stack([entry.vector for entry in self._index_entries])
+            else:
+                self._index = np.zeros((0, VECTOR_DIM), dtype=np.float32)
+        return self._index, self._index_entries
 
 class MemoryManager:
-    def __init__(self, app: Client, mistral_client: Mistral, config: dict):
+    def __init__(self, app: Client, mistral_client: Mistral, config: dict, store=None, owner: bool = True,
+                 llm: ResilientCompletions = None):
         self.app = app
         self.mistral = mistral_client
+        self.llm = llm or ResilientCompletions(mistral_client, config)
         self.config = config
+        # В режиме супервизора память пишет только процесс-владелец, остальные ставят ему задачи в общем хранилище
+        self.store = store
+        self.owner = owner
         self.memory_lock = asyncio.Lock()
         self.memory_file = Path('memory.txt')
-        self.memory: List[MemoryEntry] = []
-        self.load_memory()
+        self.partitions: Dict[str, MemoryPartition] = {}
+        self._heap_seq = itertools.count()
+        self._size = 0
+        self.partition_quota = config.get('memory_partition_quota', 200)
+        self.memory_budget = config.get('memory_budget', 1000)
+        self.half_life = config.get('memory_half_life_days', 30) * 24 * 3600
+        self._load_task: Optional[asyncio.Task] = None
+        self._loaded_mtime: Optional[float] = None
+        self.similarity_threshold = config.get('memory_similarity_threshold', 0.85)
         logger.info("MemoryManager initialized successfully")
 
-    def load_memory(self):
-        """Загружает память из файла при старте"""
+    async def ensure_loaded(self):
+        """Загружает память в фоновом потоке один раз, повторные вызовы ждут ту же загрузку"""
+        if self._load_task is None:
+            self._load_task = asyncio.create_task(self.load_memory())
+        await asyncio.shield(self._load_task)
+
+    async def load_memory(self):
+        """Загружает память из файла: разбор и векторизация идут в потоке, подмена разделов — в цикле событий"""
         try:
-            if self.memory_file.exists():
-                with open(self.memory_file, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                    if content:
-                        entries = content.split('\n\n')
-                        for entry in entries:
-                            if not entry.strip():
-                                continue
-                            try:
-                                lines = entry.strip().split('\n')
-                                timestamp = float(lines[0].split(': ')[1])
-                                importance = int(lines[1].split(': ')[1])
-                                chat = lines[2].split(': ')[1]
-                                context = lines[3].split(': ')[1]
-                                content = lines[4].split(': ')[1]
-                                
-                                self.memory.append(MemoryEntry(
-                                    content=content,
-                                    timestamp=timestamp,
-                                    importance=importance,
-                                    context=context,
-                                    chat_title=chat
-                                ))
-                            except Exception as e:
-                                logger.error(f"Error parsing memory entry: {e}")
-                        logger.info(f"Loaded {len(self.memory)} memory entries")
+            loaded, mtime = await asyncio.to_thread(self._read_memory_file)
+            # Разделы читает get_relevant_memory в цикле событий, поэтому меняем их только здесь
+            self._rebuild(loaded)
+            self._evict_over_limits(self.partitions.values())
+            self._loaded_mtime = mtime
+            logger.info(f"Loaded {len(loaded)} memory entries into {len(self.partitions)} chat partitions")
         except Exception as e:
             logger.error(f"Error loading memory: {e}")
 
+    def _read_memory_file(self) -> Tuple[List[MemoryEntry], Optional[float]]:
+        """Разбирает файл памяти и считает векторы записей, не трогая состояние менеджера"""
+        loaded: List[MemoryEntry] = []
+        mtime = None
+        if self.memory_file.exists():
+            mtime = self.memory_file.stat().st_mtime
+            with open(self.memory_file, 'r', encoding='utf-8') as f:
+                content = f.read()
+                if content:
+                    entries = content.split('\n\n')
+                    for entry in entries:
+                        if not entry.strip():
+                            continue
+                        try:
+                            lines = entry.strip().split('\n')
+                            timestamp = float(lines[0].split(': ')[1])
+                            importance = int(lines[1].split(': ')[1])
+                            chat = lines[2].split(': ')[1]
+                            context = lines[3].split(': ')[1]
+                            content = lines[4].split(': ')[1]
+                            
+                            loaded.append(MemoryEntry(
+                                content=content,
+                                timestamp=timestamp,
+                                importance=importance,
+                                context=context,
+                                chat_title=chat
+                            ))
+                        except Exception as e:
+                            logger.error(f"Error parsing memory entry: {e}")
+        self._attach_vectors(loaded)
+        return loaded, mtime
+
     async def save_memory(self):
         """Сохраняет память в файл"""
         try:
-            with open(self.memory_file, 'w', encoding='utf-8') as f:
+            # Пишем во временный файл и атомарно подменяем, чтобы другие процессы не прочитали файл наполовину
+            tmp_file = self.memory_file.with_name(self.memory_file.name + '.tmp')
+            with open(tmp_file, 'w', encoding='utf-8') as f:
                 for entry in self.memory:
                     f.write(f"Timestamp: {entry.timestamp}\n")
                     f.write(f"Importance: {entry.importance}\n")
                     f.write(f"Chat: {entry.chat_title}\n")
                     f.write(f"Context: {entry.context}\n")
                     f.write(f"Content: {entry.content}\n\n")
+            os.replace(tmp_file, self.memory_file)
             logger.info(f"Saved {len(self.memory)} memory entries")
         except Exception as e:
             logger.error(f"Error saving memory: {e}")
 
-    async def process_conversation(self, messages: List[Message], bot_responses: List[str], chat_title: str):
-        """Обрабатывает группу сообщений и создает новые записи в памяти"""
+    @staticmethod
+    def conversation_payload(messages: List[Message], bot_responses: List[str], chat_title: str) -> dict:
+        """Сериализует группу сообщений, чтобы её можно было обработать позже или в другом процессе"""
+        return {
+            'timestamp': datetime.now().isoformat(),
+            'chat_title': chat_title,
+            'messages': [{
+                'user_name': f"{msg.from_user.first_name} {msg.from_user.last_name or ''}" if msg.from_user else "Unknown",
+                'text': msg.text if msg.text else str(msg.sticker.emoji if msg.sticker else ""),
+                'timestamp': str(msg.date)
+            } for msg in messages],
+            'bot_responses': bot_responses
+        }
+
+    async def handle_conversation(self, conversation: dict):
+        """Обрабатывает сериализованную беседу или передает её владельцу памяти; ошибки пробрасываются для повтора"""
+        if self.store and not self.owner:
+            await asyncio.to_thread(self.store.add_job, 'memory', conversation)
+            return
+        await self.process_conversation_data(conversation)
+
+    async def process_conversation_data(self, conversation: dict):
+        """Извлекает записи памяти из уже сериализованной беседы"""
+        chat_title = conversation['chat_title']
+        await self.ensure_loaded()
         async with self.memory_lock:
             try:
                 conversation_data = {
-                    'timestamp': datetime.now().isoformat(),
-                    'chat_title': chat_title,
-                    'messages': [{
-                        'user_name': f"{msg.from_user.first_name} {msg.from_user.last_name or ''}" if msg.from_user else "Unknown",
-                        'text': msg.text if msg.text else str(msg.sticker.emoji if msg.sticker else ""),
-                        'timestamp': msg.date
-                    } for msg in messages],
-                    'bot_responses': bot_responses,
+                    **conversation,
                     'current_memory': [
                         f"Importance: {entry.importance}\nContent: {entry.content}\nContext: {entry.context}"
-                        for entry in sorted(self.memory, key=lambda x: x.importance, reverse=True)
+                        for entry in self._top_entries(self._partition_entries(chat_title), self.partition_quota)
                     ]
                 }
                 
-                chat_response = self.mistral.agents.complete(
+                chat_response = await self.llm.complete(
                     agent_id=self.config['memory_agent_id'],
                     messages=[{
                         "role": "user",
                         "content": f"Проанализируй эту беседу и выдели значимую информацию ориентируясь на структуру в промпте: {conversation_data}"
-                    }]
+                    }],
+                    timeout=self.config.get('llm_memory_timeout')
                 )
-                logger.info(f"Memory response: {chat_response}")
+                payload_logger.debug("Memory response: %s", chat_response)
 
                 if not chat_response.choices or not chat_response.choices[0].message.content:
                     logger.warning("Received empty response from Mistral API")
@@ -142,46 +263,161 @@ class MemoryManager:
                     except (IndexError, ValueError) as e:
                         logger.error(f"Error parsing memory entry: {e}\nEntry content: {entry}")
                         continue
-                self.memory.extend(memory_entries)
-                await self.cleanup_memory()
+                self.consolidate(memory_entries)
+                await self.cleanup_memory([chat_title])
                 await self.save_memory()
                 logger.info("Memory has been replaced and saved.")
                     
             except Exception as e:
                 logger.error(f"Error processing conversation: {e}")
+                raise
+
+    @property
+    def memory(self) -> List[MemoryEntry]:
+        """Все записи памяти по всем чатам"""
+        return [entry for partition in self.partitions.values() for entry in partition.entries.values()]
+
+    def _attach_vectors(self, entries: List[MemoryEntry]):
+        missing = [entry for entry in entries if entry.vector is None]
+        if missing:
+            for entry, vector in zip(missing, vectorize([entry.content for entry in missing])):
+                entry.vector = vector
+
+    def _rebuild(self, entries: List[MemoryEntry]):
+        """Заново раскладывает записи по разделам чатов и строит кучи вытеснения за O(n)"""
+        partitions: Dict[str, MemoryPartition] = {}
+        for entry in entries:
+            partition = partitions.setdefault(entry.chat_title, MemoryPartition(entry.chat_title))
+            partition.add(entry)
+            partition.heap.append((eviction_key(entry, self.half_life), next(self._heap_seq), entry))
+        for partition in partitions.values():
+            heapq.heapify(partition.heap)
+        self.partitions = partitions
+        self._size = len(entries)
+
+    def _track(self, entry: MemoryEntry):
+        """Кладет актуальный ключ записи в кучу чата; прежние элементы кучи для неё становятся устаревшими"""
+        item = (eviction_key(entry, self.half_life), next(self._heap_seq), entry)
+        heapq.heappush(self.partitions[entry.chat_title].heap, item)
+
+    def _add(self, entry: MemoryEntry):
+        if entry.chat_title not in self.partitions:
+            self.partitions[entry.chat_title] = MemoryPartition(entry.chat_title)
+        self.partitions[entry.chat_title].add(entry)
+        self._size += 1
+        self._track(entry)
+
+    def _evict_lowest(self, partition: MemoryPartition):
+        """Вытесняет запись чата с наименьшей оценкой, пропуская удаленные и устаревшие элементы кучи"""
+        while partition.heap:
+            key, _, entry = heapq.heappop(partition.heap)
+            if entry in partition and key == eviction_key(entry, self.half_life):
+                partition.remove(entry)
+                self._size -= 1
+                break
+        if not partition:
+            del self.partitions[partition.chat_title]
+        elif len(partition.heap) > 2 * len(partition) + 64:
+            # Ленивое удаление оставляет мусор в куче; пересобираем её, когда мусора больше, чем живых записей
+            partition.heap = [(eviction_key(entry, self.half_life), next(self._heap_seq), entry)
+                              for entry in partition.entries.values()]
+            heapq.heapify(partition.heap)
+
+    def _evict_over_limits(self, partitions: Iterable[MemoryPartition]) -> int:
+        """Вытесняет записи сверх квоты чата, а сверх общего бюджета — из самого большого чата"""
+        evicted = 0
+        for partition in list(partitions):
+            while len(partition) > self.partition_quota:
+                self._evict_lowest(partition)
+                evicted += 1
+        while self._size > self.memory_budget:
+            self._evict_lowest(max(self.partitions.values(), key=len))
+            evicted += 1
+        return evicted
+
+    def consolidate(self, new_entries: List[MemoryEntry]):
+        """Добавляет новые записи, сливая почти-дубликаты в рамках одного чата по косинусной близости"""
+        if not new_entries:
+            return
+        self._attach_vectors(new_entries)
+        by_chat: Dict[str, List[MemoryEntry]] = {}
+        for entry in new_entries:
+            by_chat.setdefault(entry.chat_title, []).append(entry)
+
+        merged = 0
+        for chat_title, chat_entries in by_chat.items():
+            partition = self.partitions.get(chat_title) or MemoryPartition(chat_title)
+            index, index_entries = partition.get_index()
+            new_vectors = np.stack([entry.vector for entry in chat_entries])
+            existing_sims = new_vectors @ index.T
+            batch_sims = new_vectors @ new_vectors.T
 
-    async def cleanup_memory(self):
-        """Очищает устаревшие или неважные записи"""
+            targets: List[MemoryEntry] = []
+            for i, entry in enumerate(chat_entries):
+                target = None
+                if existing_sims.shape[1]:
+                    best = int(np.argmax(existing_sims[i]))
+                    if existing_sims[i, best] >= self.similarity_threshold:
+                        target = index_entries[best]
+                if target is None and i:
+                    best = int(np.argmax(batch_sims[i, :i]))
+                    if batch_sims[i, best] >= self.similarity_threshold:
+                        target = targets[best]
+
+                if target is None:
+                    self._add(entry)
+                    targets.append(entry)
+                else:
+                    self._merge_into(target, entry)
+                    self.partitions[chat_title].invalidate_index()
+                    self._track(target)
+                    targets.append(target)
+                    merged += 1
+
+        if merged:
+            logger.info(f"Consolidated {merged} of {len(new_entries)} new memory entries into existing ones")
+
+    @staticmethod
+    def _merge_into(target: MemoryEntry, entry: MemoryEntry):
+        if entry.importance >= target.importance:
+            target.content = entry.content
+            target.context = entry.context
+            target.vector = entry.vector
+        target.importance = max(target.importance, entry.importance)
+        target.timestamp = max(target.timestamp, entry.timestamp)
+
+    async def cleanup_memory(self, chat_titles: Iterable[str] = None):
+        """Вытесняет записи сверх квот чатов и общего бюджета, не сортируя всю память"""
         try:
-            self.memory.sort(key=lambda x: (x.importance, -x.timestamp))
-            
-            current_time = time.time()
-            filtered_memory = [
-                entry for entry in self.memory
-                if (current_time - entry.timestamp < 30 * 24 * 3600) or
-                (entry.importance >= 7)
-            ][:1000]
-
-            unique_entries = {}
-            for entry in filtered_memory:
-                unique_key = (entry.content, entry.chat_title)
-                if unique_key not in unique_entries:
-                    unique_entries[unique_key] = entry
-            
-            self.memory = list(unique_entries.values())
-            logger.info(f"Cleaned up memory. Current entries: {len(self.memory)}")
+            titles = self.partitions.keys() if chat_titles is None else chat_titles
+            partitions = [self.partitions[title] for title in set(titles) if title in self.partitions]
+            evicted = self._evict_over_limits(partitions)
+            logger.info(f"Cleaned up memory. Evicted {evicted}, current entries: {self._size}")
         except Exception as e:
             logger.error(f"Error cleaning up memory: {e}")
 
-    def get_relevant_memory(self, context: str = None) -> str:
-        """Возвращает релевантную память для текущего контекста"""
+    def _partition_entries(self, chat_title: str) -> Iterable[MemoryEntry]:
+        partition = self.partitions.get(chat_title)
+        return partition.entries.values() if partition else ()
+
+    def _top_entries(self, entries: Iterable[MemoryEntry], limit: int, context: str = None) -> List[MemoryEntry]:
+        return heapq.nlargest(
+            limit,
+            (entry for entry in entries if not context or entry.context == context),
+            key=lambda entry: eviction_key(entry, self.half_life)
+        )
+
+    def get_relevant_memory(self, context: str = None, chat_title: str = None, limit: int = 10) -> str:
+        """Возвращает релевантную память: сначала записи текущего чата, затем самые ценные из остальных"""
         try:
-            relevant_entries = sorted(
-                [entry for entry in self.memory if not context or entry.context == context],
-                key=lambda x: (x.importance, -x.timestamp),
-                reverse=True
-            )[:10]
-            
+            relevant_entries = self._top_entries(self._partition_entries(chat_title), limit * 2 // 3, context)
+            seen = {id(entry) for entry in relevant_entries}
+            relevant_entries += self._top_entries(
+                (entry for entry in self.memory if id(entry) not in seen),
+                limit - len(relevant_entries),
+                context
+            )
+
             return "\n".join([
                 f"[{entry.importance}] {entry.content} (Context: {entry.context}, Chat: {entry.chat_title})"
                 for entry in relevant_entries
@@ -190,7 +426,22 @@ class MemoryManager:
             logger.error(f"Error getting relevant memory: {e}")
             return ""
 
-def setup(app: Client, mistral_client: Mistral, config: dict) -> MemoryManager:
+    async def start_shared_loop(self, interval: float = 5):
+        """Перечитывает файл памяти, обновленный процессом-владельцем"""
+        await self.ensure_loaded()
+        while True:
+            try:
+                if self.memory_file.exists() and self.memory_file.stat().st_mtime != self._loaded_mtime:
+                    await self.load_memory()
+            except Exception as e:
+                logger.error(f"Error syncing shared memory: {e}")
+            await asyncio.sleep(interval)
+
+def setup(app: Client, mistral_client: Mistral, config: dict, store=None, owner: bool = True,
+          llm: ResilientCompletions = None) -> MemoryManager:
     """Инициализирует менеджер памяти"""
     logger.info("Setting up MemoryManager...")
-    return MemoryManager(app, mistral_client, config)
+    memory_manager = MemoryManager(app, mistral_client, config, store=store, owner=owner, llm=llm)
+    if store and not owner:
+        asyncio.create_task(memory_manager.start_shared_loop())
+    return memory_manager
@@ -0,0 +1,170 @@
+import time
+import random
+import asyncio
+import logging
+from collections import Counter, deque
+from typing import Deque, Dict, List, Optional
+import httpx
+from mistralai import Mistral
+
+logger = logging.getLogger('Resilience')
+
+HEDGE_MIN_SAMPLES = 20
+# Пропуски автомата: обычный запрос при закрытом автомате и единственный пробный после cooldown
+PERMIT_CLOSED = 'closed'
+PERMIT_TRIAL = 'trial'
+
+class CircuitOpenError(Exception):
+    """Провайдер признан нездоровым, запрос не отправлялся"""
+
+def is_transient(error: Exception) -> bool:
+    """Таймауты, сетевые сбои, 429 и 5xx стоит повторять; прочие ошибки клиента не говорят о здоровье провайдера"""
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError, httpx.TransportError)):
+        return True
+    status = getattr(getattr(error, 'raw_response', None), 'status_code', None)
+    return status is not None and (status == 429 or status >= 500)
+
+class CircuitBreaker:
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_in_flight = False
+
+    def allow(self) -> Optional[str]:
+        """Закрыт — пропускает всё; открыт — ничего; после cooldown выдает один пробный пропуск, иначе None"""
+        if self.opened_at is None:
+            return PERMIT_CLOSED
+        if time.monotonic() - self.opened_at < self.cooldown or self.trial_in_flight:
+            return None
+        self.trial_in_flight = True
+        return PERMIT_TRIAL
+
+    def record_success(self, permit: str):
+        if self.opened_at is not None:
+            logger.info("Circuit closed, provider recovered")
+        self.failures = 0
+        self.opened_at = None
+        self.release(permit)
+
+    def release(self, permit: str):
+        """Освобождает слот пробного запроса, но только если его держит именно этот вызов"""
+        if permit == PERMIT_TRIAL:
+            self.trial_in_flight = False
+
+    def record_failure(self, permit: str):
+        self.failures += 1
+        # Запрос, начатый до открытия автомата, не должен ни переоткрывать его, ни освобождать чужой пробный слот
+        if permit == PERMIT_TRIAL or (self.opened_at is None and self.failures >= self.threshold):
+            logger.warning(f"Circuit opened after {self.failures} consecutive failures")
+            self.opened_at = time.monotonic()
+        self.release(permit)
+
+class ResilientCompletions:
+    """Вызовы агентов Mistral с дедлайном, хеджированием, повторами и автоматом отключения"""
+
+    def __init__(self, mistral_client: Mistral, config: dict, counters: Optional[Counter] = None):
+        self.mistral = mistral_client
+        self.timeout = config.get('llm_timeout', 30)
+        self.hedge_after = config.get('llm_hedge_after', 8)
+        self.hedge_percentile = config.get('llm_hedge_percentile', 0.95)
+        self.latency_window = config.get('llm_latency_window', 200)
+        self.latencies: Dict[str, Deque[float]] = {}
+        self.retries = config.get('llm_retries', 2)
+        self.backoff = config.get('llm_backoff', 0.5)
+        self.breaker_threshold = config.get('llm_breaker_threshold', 5)
+        self.breaker_cooldown = config.get('llm_breaker_cooldown', 60)
+        # Свой автомат у каждого агента: сломанный фоновый агент не должен глушить ответы в чатах
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.counters = counters if counters is not None else Counter()
+
+    async def complete(self, agent_id: str, messages: List[dict], timeout: float = None, hedge: bool = False):
+        """Возвращает ответ агента или поднимает последнюю ошибку, если все попытки исчерпаны"""
+        timeout = timeout or self.timeout
+        breaker = self.breaker(agent_id)
+        last_error: Exception = CircuitOpenError(f"LLM circuit for agent {agent_id} is open")
+        for attempt in range(self.retries + 1):
+            permit = breaker.allow()
+            if not permit:
+                self.counters['llm_circuit_open'] += 1
+                break
+            try:
+                if attempt:
+                    self.counters['llm_retries'] += 1
+                    # Full jitter: случайная задержка в пределах экспоненциально растущего окна
+                    await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+                started = time.monotonic()
+                response = await asyncio.wait_for(self._attempt(agent_id, messages, timeout, hedge), timeout)
+                self._record_latency(agent_id, time.monotonic() - started)
+                breaker.record_success(permit)
+                self.counters['llm_success'] += 1
+                return response
+            except asyncio.TimeoutError:
+                self.counters['llm_timeouts'] += 1
+                last_error = TimeoutError(f"Agent {agent_id} did not respond within {timeout}s")
+            except Exception as e:
+                if not is_transient(e):
+                    # Ошибку запроса (400/401/404/422) повтор не исправит; провайдер при этом жив
+                    self.counters['llm_client_errors'] += 1
+                    breaker.release(permit)
+                    raise
+                self.counters['llm_errors'] += 1
+                last_error = e
+            except BaseException:
+                # Отмена ничего не говорит о здоровье провайдера, но пробный слот занимать вечно нельзя
+                breaker.release(permit)
+                raise
+            breaker.record_failure(permit)
+            logger.warning(f"LLM call to {agent_id} failed (attempt {attempt + 1}): {last_error}")
+        raise last_error
+
+    def breaker(self, agent_id: str) -> CircuitBreaker:
+        breaker = self.breakers.get(agent_id)
+        if breaker is None:
+            breaker = self.breakers[agent_id] = CircuitBreaker(self.breaker_threshold, self.breaker_cooldown)
+        return breaker
+
+    def _record_latency(self, agent_id: str, latency: float):
+        samples = self.latencies.get(agent_id)
+        if samples is None:
+            samples = self.latencies[agent_id] = deque(maxlen=self.latency_window)
+        samples.append(latency)
+
+    def hedge_delay(self, agent_id: str) -> float:
+        """Перцентиль недавних задержек агента; пока выборка мала, используется статический llm_hedge_after"""
+        samples = self.latencies.get(agent_id)
+        if not self.hedge_after or not samples or len(samples) < HEDGE_MIN_SAMPLES:
+            return self.hedge_after
+        ordered = sorted(samples)
+        return ordered[min(int(len(ordered) * self.hedge_percentile), len(ordered) - 1)]
+
+    async def _attempt(self, agent_id: str, messages: List[dict], timeout: float, hedge: bool):
+        def request():
+            return asyncio.create_task(self.mistral.agents.complete_async(
+                agent_id=agent_id, messages=messages, timeout_ms=int(timeout * 1000)
+            ))
+
+        primary = request()
+        pending = {primary}
+        try:
+            hedge_after = self.hedge_delay(agent_id) if hedge else None
+            if hedge_after and hedge_after < timeout:
+                done, _ = await asyncio.wait(pending, timeout=hedge_after)
+                if not done:
+                    self.counters['llm_hedged'] += 1
+                    pending.add(request())
+
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.counters['llm_hedge_wins'] += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
@@ -0,0 +1,34 @@
+import os
+import json
+from dataclasses import dataclass, field, asdict
+from typing import List, Optional
+
+ALL_SUBSYSTEMS = ('replies', 'digest', 'memory', 'leo')
+WORKER_ENV = 'DENBOT_WORKER'
+
+def shard_for(chat_id: int, shard_count: int) -> int:
+    """Детерминированно сопоставляет чат номеру шарда"""
+    return chat_id % shard_count
+
+@dataclass
+class WorkerSpec:
+    name: str = 'main'
+    session: str = 'my_account'
+    subsystems: List[str] = field(default_factory=lambda: list(ALL_SUBSYSTEMS))
+    shard_index: int = 0
+    shard_count: int = 1
+    store_path: Optional[str] = None
+
+    def runs(self, subsystem: str) -> bool:
+        return subsystem in self.subsystems
+
+    def owns_chat(self, chat_id: int) -> bool:
+        return shard_for(chat_id, self.shard_count) == self.shard_index
+
+    def to_env(self) -> str:
+        return json.dumps(asdict(self))
+
+def load_worker_spec() -> WorkerSpec:
+    """Читает описание воркера из окружения; без супервизора процесс работает со всеми подсистемами"""
+    raw = os.environ.get(WORKER_ENV)
+    return WorkerSpec(**json.loads(raw)) if raw else WorkerSpec()
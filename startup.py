@@ -0,0 +1,61 @@
+import time
+import asyncio
+import logging
+from typing import Awaitable, Dict, List, Optional
+
+logger = logging.getLogger('Startup')
+
+class StartupOrchestrator:
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.ready_at: Optional[float] = None
+        self.timings: Dict[str, float] = {}
+        self.failures: Dict[str, str] = {}
+        self.background_tasks: List[asyncio.Task] = []
+
+    async def run(self, name: str, awaitable: Awaitable):
+        """Выполняет этап запуска и замеряет его длительность"""
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        except Exception as e:
+            self.failures[name] = str(e)
+            raise
+        finally:
+            self.timings[name] = time.perf_counter() - started
+
+    async def gather(self, **stages: Awaitable) -> dict:
+        """Выполняет независимые этапы параллельно и возвращает их результаты по имени"""
+        results = await asyncio.gather(*(self.run(name, stage) for name, stage in stages.items()))
+        return dict(zip(stages.keys(), results))
+
+    def warm(self, name: str, awaitable: Awaitable) -> asyncio.Task:
+        """Запускает прогрев кэша в фоне, не блокируя обработку сообщений"""
+        async def runner():
+            try:
+                return await self.run(name, awaitable)
+            except Exception as e:
+                logger.error(f"Warmup '{name}' failed: {e}")
+
+        task = asyncio.create_task(runner())
+        self.background_tasks.append(task)
+        return task
+
+    def mark_ready(self):
+        """Отмечает момент, когда бот начал обрабатывать сообщения"""
+        self.ready_at = time.perf_counter()
+        logger.info(f"Message handling started after {self.ready_at - self.started_at:.2f}s")
+
+    async def finish(self):
+        """Дожидается фоновых задач и пишет отчет о времени запуска"""
+        await asyncio.gather(*self.background_tasks)
+        self.report()
+
+    def report(self):
+        total = time.perf_counter() - self.started_at
+        ready = (self.ready_at - self.started_at) if self.ready_at else total
+        lines = [f"Startup report: ready in {ready:.2f}s, fully warmed in {total:.2f}s"]
+        for name, duration in sorted(self.timings.items(), key=lambda x: x[1], reverse=True):
+            status = f" (failed: {self.failures[name]})" if name in self.failures else ""
+            lines.append(f"  {name}: {duration:.2f}s{status}")
+        logger.info("\n".join(lines))
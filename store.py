@@ -0,0 +1,147 @@
+import json
+import time
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger('SharedStore')
+
+class SharedStore:
+    """Локальное хранилище на SQLite для обмена буферами и метриками между процессами-воркерами"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self._transaction() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS buffers (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    buffer TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    created REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS buffers_by_name ON buffers (buffer, id)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    available_at REAL NOT NULL,
+                    last_error TEXT
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, available_at, id)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS metrics (
+                    worker TEXT PRIMARY KEY,
+                    payload TEXT NOT NULL,
+                    updated REAL NOT NULL
+                )
+            """)
+
+    def _connect(self) -> sqlite3.Connection:
+        # Соединения SQLite нельзя делить между потоками, а вызовы идут через asyncio.to_thread
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """BEGIN IMMEDIATE берет блокировку на запись сразу, чтобы чтение и удаление шли атомарно между процессами"""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+
+    def push(self, buffer: str, item: dict):
+        """Добавляет элемент в конец именованного буфера"""
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO buffers (buffer, payload, created) VALUES (?, ?, ?)",
+                (buffer, json.dumps(item, ensure_ascii=False), time.time())
+            )
+
+    def peek(self, buffer: str) -> List[Tuple[int, dict]]:
+        """Читает элементы буфера в порядке добавления вместе с их id, не удаляя их"""
+        rows = self._connect().execute(
+            "SELECT id, payload FROM buffers WHERE buffer = ? ORDER BY id", (buffer,)
+        ).fetchall()
+        return [(row_id, json.loads(payload)) for row_id, payload in rows]
+
+    def discard(self, buffer: str, last_id: int):
+        """Удаляет из буфера элементы до last_id включительно, когда они уже обработаны"""
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM buffers WHERE buffer = ? AND id <= ?", (buffer, last_id))
+
+    def count(self, buffer: str) -> int:
+        return self._connect().execute(
+            "SELECT COUNT(*) FROM buffers WHERE buffer = ?", (buffer,)
+        ).fetchone()[0]
+
+    def add_job(self, kind: str, payload: dict) -> int:
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "INSERT INTO jobs (kind, payload, available_at) VALUES (?, ?, ?)",
+                (kind, json.dumps(payload, ensure_ascii=False), time.time())
+            )
+        return cursor.lastrowid
+
+    def claim_job(self) -> Optional[Tuple[int, str, dict, int]]:
+        """Атомарно помечает самую старую готовую задачу как выполняемую и возвращает её"""
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT id, kind, payload, attempts FROM jobs "
+                "WHERE status = 'pending' AND available_at <= ? ORDER BY id LIMIT 1",
+                (time.time(),)
+            ).fetchone()
+            if row:
+                conn.execute("UPDATE jobs SET status = 'running' WHERE id = ?", (row[0],))
+        return (row[0], row[1], json.loads(row[2]), row[3]) if row else None
+
+    def complete_job(self, job_id: int):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def retry_job(self, job_id: int, available_at: float, error: str, give_up: bool = False):
+        """Откладывает задачу до available_at или, если попытки кончились, оставляет её со статусом failed"""
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts + 1, available_at = ?, last_error = ? WHERE id = ?",
+                ('failed' if give_up else 'pending', available_at, error, job_id)
+            )
+
+    def requeue_running_jobs(self) -> int:
+        """Возвращает в очередь задачи, прерванные падением процесса"""
+        with self._transaction() as conn:
+            return conn.execute("UPDATE jobs SET status = 'pending' WHERE status = 'running'").rowcount
+
+    def next_job_time(self) -> Optional[float]:
+        return self._connect().execute(
+            "SELECT MIN(available_at) FROM jobs WHERE status = 'pending'"
+        ).fetchone()[0]
+
+    def report_metrics(self, worker: str, metrics: dict):
+        """Сохраняет последний снимок метрик воркера"""
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO metrics (worker, payload, updated) VALUES (?, ?, ?)",
+                (worker, json.dumps(metrics, ensure_ascii=False), time.time())
+            )
+
+    def read_metrics(self) -> Dict[str, Tuple[float, dict]]:
+        """Возвращает снимки метрик всех воркеров вместе со временем обновления"""
+        rows = self._connect().execute("SELECT worker, payload, updated FROM metrics").fetchall()
+        return {worker: (updated, json.loads(payload)) for worker, payload, updated in rows}
@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+from dataclasses import dataclass, asdict
+from mistralai import Mistral
+from pyrogram import Client
+from logs import PAYLOAD_LOGGER
+from resilience import ResilientCompletions
+
+logger = logging.getLogger('SummaryManager')
+payload_logger = logging.getLogger(PAYLOAD_LOGGER)
+
+@dataclass
+class ChatSummary:
+    text: str = ""
+    covered_until_id: int = 0
+    updated: float = 0.0
+
+class SummaryManager:
+    def __init__(self, app: Client, mistral_client: Mistral, config: dict,
+                 format_message: Callable, summary_file: str = 'summaries.json', llm: ResilientCompletions = None):
+        self.app = app
+        self.mistral = mistral_client
+        self.llm = llm or ResilientCompletions(mistral_client, config)
+        self.config = config
+        # Форматирует сообщение так же, как история в промпте: возвращает (role, text) или None
+        self.format_message = format_message
+        self.summary_file = Path(summary_file)
+        self.agent_id = config['summary_agent_id']
+        self.batch_size = config.get('summary_batch_size', 50)
+        self.max_backlog = config.get('summary_max_backlog', 500)
+        self.max_chars = config.get('summary_max_chars', 1500)
+        self.refresh_interval = config.get('summary_refresh_interval', 300)
+        self.summaries: Dict[int, ChatSummary] = {}
+        self.refresh_tasks: Dict[int, asyncio.Task] = {}
+        self.load_summaries()
+        logger.info("SummaryManager initialized successfully")
+
+    def load_summaries(self):
+        """Загружает сохраненные сводки чатов"""
+        try:
+            if self.summary_file.exists():
+                with self.summary_file.open('r', encoding='utf-8') as f:
+                    self.summaries = {int(chat_id): ChatSummary(**data) for chat_id, data in json.load(f).items()}
+                logger.info(f"Loaded summaries for {len(self.summaries)} chats")
+        except Exception as e:
+            logger.error(f"Error loading summaries: {e}")
+
+    def _save_summaries(self, snapshot: dict):
+        tmp_file = self.summary_file.with_name(self.summary_file.name + '.tmp')
+        with tmp_file.open('w', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+        os.replace(tmp_file, self.summary_file)
+
+    def get_summary(self, chat_id: int) -> str:
+        summary = self.summaries.get(chat_id)
+        return summary.text if summary else ""
+
+    def schedule_refresh(self, chat_id: int, oldest_window_id: int):
+        """Запускает фоновое свертывание сообщений, выпавших из окна истории, не чаще refresh_interval"""
+        summary = self.summaries.get(chat_id)
+        if summary and (oldest_window_id <= summary.covered_until_id + 1 or
+                        time.time() - summary.updated < self.refresh_interval):
+            return
+        task = self.refresh_tasks.get(chat_id)
+        if task and not task.done():
+            return
+        self.refresh_tasks[chat_id] = asyncio.create_task(self.refresh(chat_id, oldest_window_id))
+
+    async def refresh(self, chat_id: int, oldest_window_id: int):
+        """Сворачивает все сообщения между уже учтенными и окном истории, пачками от старых к новым"""
+        try:
+            summary = self.summaries.get(chat_id) or ChatSummary()
+            pending = []
+            # История отдается от новых к старым; при первом запуске сворачиваем не больше max_backlog сообщений
+            async for message in self.app.get_chat_history(chat_id, limit=self.max_backlog, offset_id=oldest_window_id):
+                if message.id <= summary.covered_until_id:
+                    break
+                pending.append(message)
+            pending.reverse()
+            if not pending:
+                self.summaries[chat_id] = ChatSummary(summary.text, summary.covered_until_id, time.time())
+                return
+
+            folded = 0
+            try:
+                for start in range(0, len(pending), self.batch_size):
+                    batch = pending[start:start + self.batch_size]
+                    lines = [formatted[1] for formatted in map(self.format_message, batch) if formatted]
+                    text = summary.text
+                    if lines:
+                        text = await self._fold(chat_id, summary.text, lines)
+                        if text is None:
+                            break
+                    # Продвигаем границу после каждой пачки, чтобы сбой не откатывал уже свернутое
+                    summary = ChatSummary(text=text, covered_until_id=batch[-1].id, updated=time.time())
+                    self.summaries[chat_id] = summary
+                    folded += len(lines)
+            finally:
+                snapshot = {str(key): asdict(value) for key, value in self.summaries.items()}
+                await asyncio.to_thread(self._save_summaries, snapshot)
+                logger.info(f"Folded {folded} of {len(pending)} messages into summary for chat {chat_id}")
+        except Exception as e:
+            logger.error(f"Error refreshing summary for chat {chat_id}: {e}")
+
+    async def _fold(self, chat_id: int, text: str, lines: List[str]) -> Optional[str]:
+        """Возвращает сводку, обновленную пачкой сообщений, или None, если модель ответила пустотой"""
+        prompt = (
+            f"Текущее краткое содержание беседы:\n{text or '(пусто)'}\n\n"
+            f"Новые сообщения:\n" + "\n".join(lines) + "\n\n"
+            f"Обнови краткое содержание с учетом новых сообщений. Сохрани важные факты, договоренности "
+            f"и кто что говорил. Не более {self.max_chars} символов, только текст сводки."
+        )
+        chat_response = await self.llm.complete(
+            agent_id=self.agent_id,
+            messages=[{"role": "user", "content": prompt}]
+        )
+        folded = (chat_response.choices[0].message.content or "").strip()
+        payload_logger.debug("Summary for chat %s: %s", chat_id, folded)
+        if not folded:
+            logger.warning(f"Received empty summary for chat {chat_id}")
+            return None
+        return folded[:self.max_chars]
+
+def setup(app: Client, mistral_client: Mistral, config: dict, format_message: Callable,
+          summary_file: str = 'summaries.json', llm: ResilientCompletions = None) -> Optional[SummaryManager]:
+    """Инициализирует менеджер сводок чатов; без отдельного агента сводки отключены"""
+    if not config.get('summary_agent_id'):
+        logger.warning("summary_agent_id is not set, chat summaries are disabled")
+        return None
+    logger.info("Setting up SummaryManager...")
+    return SummaryManager(app, mistral_client, config, format_message, summary_file, llm=llm)
@@ -0,0 +1,125 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+from collections import Counter
+from typing import Dict, List
+
+from logs import setup_logging
+from sharding import ALL_SUBSYSTEMS, WORKER_ENV, WorkerSpec
+from store import SharedStore
+
+logger = logging.getLogger('Supervisor')
+
+HEALTH_INTERVAL = 30
+STALE_HEARTBEAT = 90
+
+class Supervisor:
+    def __init__(self, config: dict):
+        self.config = config
+        self.store_path = config.get('shared_store_path', 'shared_store.db')
+        self.specs = self._build_specs()
+        self.processes: Dict[str, asyncio.subprocess.Process] = {}
+        self.restarts = Counter()
+
+    def _build_specs(self) -> List[WorkerSpec]:
+        """Строит описания воркеров из конфига и раздает шарды воркерам, отвечающим на сообщения"""
+        workers = self.config.get('workers') or []
+        if not workers:
+            raise ValueError("Supervisor mode requires a non-empty 'workers' list in config.json")
+
+        repliers = [worker for worker in workers if 'replies' in worker.get('subsystems', ALL_SUBSYSTEMS)]
+        specs = []
+        for worker in workers:
+            subsystems = list(worker.get('subsystems', ALL_SUBSYSTEMS))
+            unknown = set(subsystems) - set(ALL_SUBSYSTEMS)
+            if unknown:
+                raise ValueError(f"Unknown subsystems for worker {worker['name']}: {', '.join(sorted(unknown))}")
+            specs.append(WorkerSpec(
+                name=worker['name'],
+                session=worker.get('session', worker['name']),
+                subsystems=subsystems,
+                shard_index=repliers.index(worker) if worker in repliers else 0,
+                shard_count=max(len(repliers), 1),
+                store_path=self.store_path
+            ))
+
+        sessions = [spec.session for spec in specs]
+        if len(set(sessions)) != len(sessions):
+            # Pyrogram держит сессию в SQLite-файле, два процесса с одним файлом блокируют друг друга
+            raise ValueError("Each worker needs its own session file")
+
+        for subsystem in ('digest', 'memory', 'leo'):
+            owners = [spec.name for spec in specs if spec.runs(subsystem)]
+            if len(owners) > 1:
+                raise ValueError(f"Subsystem '{subsystem}' must run in exactly one worker, got: {', '.join(owners)}")
+            if not owners:
+                logger.warning(f"Subsystem '{subsystem}' is not assigned to any worker")
+        return specs
+
+    async def _run_worker(self, spec: WorkerSpec):
+        """Запускает процесс воркера и перезапускает его с экспоненциальной задержкой при падении"""
+        while True:
+            started = time.time()
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, 'main.py',
+                env={**os.environ, WORKER_ENV: spec.to_env()}
+            )
+            self.processes[spec.name] = process
+            logger.info(f"Started worker {spec.name} (pid {process.pid}, subsystems: {', '.join(spec.subsystems)}, "
+                        f"shard {spec.shard_index}/{spec.shard_count})")
+            try:
+                returncode = await process.wait()
+            except asyncio.CancelledError:
+                if process.returncode is None:
+                    process.terminate()
+                    await process.wait()
+                raise
+
+            if time.time() - started > 300:
+                self.restarts[spec.name] = 0
+            self.restarts[spec.name] += 1
+            delay = min(2 ** self.restarts[spec.name], 60)
+            logger.error(f"Worker {spec.name} exited with code {returncode}, restarting in {delay}s")
+            await asyncio.sleep(delay)
+
+    async def _health_loop(self, store: SharedStore):
+        """Периодически сводит метрики воркеров и пишет общий отчет о здоровье"""
+        while True:
+            await asyncio.sleep(HEALTH_INTERVAL)
+            try:
+                snapshots = await asyncio.to_thread(store.read_metrics)
+                totals = Counter()
+                lines = []
+                for spec in self.specs:
+                    process = self.processes.get(spec.name)
+                    alive = process is not None and process.returncode is None
+                    updated, metrics = snapshots.get(spec.name, (0, {}))
+                    age = time.time() - updated
+                    status = "ok" if alive and age < STALE_HEARTBEAT else "stale" if alive else "down"
+                    counters = metrics.get('counters', {})
+                    totals.update(counters)
+                    lines.append(f"  {spec.name}: {status}, restarts {self.restarts[spec.name]}, "
+                                 f"heartbeat {age:.0f}s ago, queue {metrics.get('queue_size', 0)}, {dict(counters)}")
+                logger.info("Worker health:\n" + "\n".join(lines) + f"\n  total: {dict(totals)}")
+            except Exception as e:
+                logger.error(f"Error collecting worker health: {e}")
+
+    async def run(self):
+        store = SharedStore(self.store_path)
+        logger.info(f"Supervising {len(self.specs)} workers, shared store: {self.store_path}")
+        await asyncio.gather(
+            self._health_loop(store),
+            *(self._run_worker(spec) for spec in self.specs)
+        )
+
+if __name__ == "__main__":
+    with open('config.json', 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    setup_logging(config)
+    try:
+        asyncio.run(Supervisor(config).run())
+    except KeyboardInterrupt:
+        logger.info("Supervisor stopped")